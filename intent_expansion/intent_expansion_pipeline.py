@@ -1,9 +1,16 @@
-import json
+import hashlib
 import os
+import tempfile
+from contextlib import contextmanager
 from typing import List, Dict, Any, Tuple
+import fastcluster
+from joblib import Parallel, delayed
 import numpy as np
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.metrics import silhouette_score
+import orjson
+import torch
+from scipy.cluster.hierarchy import fcluster
+from scipy.linalg.blas import sgemm
+from sklearn.metrics import calinski_harabasz_score, silhouette_score
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
@@ -12,8 +19,8 @@ from tqdm import tqdm
 # ----------------------------------------------------------------------
 
 def load_inputs(path: str) -> Dict[str, Any]:
-    with open(path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
 
 
 # ----------------------------------------------------------------------
@@ -31,16 +38,224 @@ def preprocess_text(txt: str) -> str:
 # 3. EMBEDDING MODEL + CLUSTERING MODULE
 # ----------------------------------------------------------------------
 
+# Linkages fastcluster can build straight from the vectors, without an n^2 matrix
+VECTOR_LINKAGES = ("ward", "centroid", "median")
+
+
+def l2_normalize(embeddings: np.ndarray) -> np.ndarray:
+    X = np.asarray(embeddings, dtype=np.float32)
+    return X / np.linalg.norm(X, axis=1, keepdims=True).clip(1e-12)
+
+
+@contextmanager
+def condensed_buffer(n: int, memmap_threshold: int = 25000):
+    """
+    float64 scratch for the condensed (upper-triangle) distances, the layout fastcluster
+    works in. Above memmap_threshold it is backed by an anonymous temp file so our copy
+    stays out of RAM.
+    """
+    size = n * (n - 1) // 2
+    if not memmap_threshold or n <= memmap_threshold:
+        yield np.empty(size, dtype=np.float64)
+        return
+
+    # TemporaryFile is unlinked up front on POSIX and delete-on-close on Windows, so the
+    # OS reclaims it once the map is gone, even if the sweep raises with views still alive
+    with tempfile.TemporaryFile(prefix="intent_distances_", suffix=".f64") as f:
+        yield np.memmap(f, dtype=np.float64, mode="w+", shape=(size,))
+
+
+def _cosine_gram(X: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    # sgemm is Fortran-ordered: hand it the transposed (F-contiguous) views of the
+    # C-ordered rows so f2py doesn't copy X on every block; .T gives C rows back
+    return sgemm(1.0, X.T, rows.T, trans_a=True).T
+
+
+def cosine_distance_matrix(embeddings: np.ndarray, chunk_rows: int = 2048) -> np.ndarray:
+    """
+    Full (n, n) cosine distance matrix. Only used on the silhouette sample, so n <= s.
+    Rows are filled in chunks so the matmul temporaries stay bounded.
+    """
+    X = l2_normalize(embeddings)
+
+    n = X.shape[0]
+    D = np.empty((n, n), dtype=np.float32)
+    for start in range(0, n, chunk_rows):
+        stop = min(start + chunk_rows, n)
+        D[start:stop] = 1.0 - _cosine_gram(X, X[start:stop])
+
+    np.clip(D, 0.0, 2.0, out=D)
+    np.fill_diagonal(D, 0.0)
+    return D
+
+
+def condensed_cosine_distances(embeddings: np.ndarray, out: np.ndarray, chunk_rows: int = 2048) -> np.ndarray:
+    """
+    Condensed cosine distances written straight into `out` (see condensed_buffer),
+    without ever materialising the (n, n) square. Each row block is only multiplied
+    against the columns to its right, so this is half the GEMM work of the full matrix.
+    """
+    X = l2_normalize(embeddings)
+
+    n = X.shape[0]
+    pos = 0
+    for start in range(0, n - 1, chunk_rows):
+        stop = min(start + chunk_rows, n - 1)
+        block = 1.0 - _cosine_gram(X[start:], X[start:stop])
+        np.clip(block, 0.0, 2.0, out=block)
+        for i in range(start, stop):
+            width = n - 1 - i
+            out[pos:pos + width] = block[i - start, i - start + 1:]
+            pos += width
+    return out
+
+
+def simplified_silhouette(X: np.ndarray, labels: np.ndarray) -> float:
+    """
+    Silhouette with centroids standing in for the per-point mean distances.
+    O(n*k*D) instead of O(n^2*D), and tracks the full score closely enough to pick k.
+    X must be L2-normalised; distances are cosine, as in the full silhouette.
+    """
+    cids, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    if not 1 < len(cids) < X.shape[0]:
+        raise ValueError("simplified silhouette needs 2 <= n_clusters < n_samples")
+
+    order = np.argsort(inverse, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    centroids = l2_normalize(np.add.reduceat(X[order], starts, axis=0))
+
+    rows = np.arange(X.shape[0])
+    D = 1.0 - X @ centroids.T
+    a = D[rows, inverse].copy()
+    D[rows, inverse] = np.inf
+    b = D.min(axis=1)
+
+    s = (b - a) / np.maximum(np.maximum(a, b), 1e-12)
+    # Same convention as sklearn: singleton clusters score 0
+    s[counts[inverse] == 1] = 0.0
+    return float(s.mean())
+
+
+def simplified_silhouette_torch(X: torch.Tensor, labels: np.ndarray) -> float:
+    """
+    simplified_silhouette on a (GPU) tensor: centroids via index_add_, distances via one matmul.
+    """
+    cids, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    if not 1 < len(cids) < X.shape[0]:
+        raise ValueError("simplified silhouette needs 2 <= n_clusters < n_samples")
+
+    inverse = torch.from_numpy(inverse).to(X.device)
+    counts = torch.from_numpy(counts).to(X.device)
+    centroids = torch.zeros((len(cids), X.shape[1]), dtype=X.dtype, device=X.device)
+    centroids = torch.nn.functional.normalize(centroids.index_add_(0, inverse, X), dim=1)
+
+    rows = torch.arange(X.shape[0], device=X.device)
+    D = 1.0 - X @ centroids.T
+    a = D[rows, inverse].clone()
+    D[rows, inverse] = float("inf")
+    b = D.min(dim=1).values
+
+    s = (b - a) / torch.clamp(torch.maximum(a, b), min=1e-12)
+    s[counts[inverse] == 1] = 0.0
+    return float(s.mean())
+
+
+# Scores the sweep can rank k by; both are O(n*k*D) per k
+SWEEP_SCORES = {
+    "simplified_silhouette": simplified_silhouette,
+    "calinski_harabasz": calinski_harabasz_score,
+}
+
+
+def _cut_and_score(tree: np.ndarray, X: np.ndarray, k: int, score_fn, min_cluster_size=1, max_cluster_frac=1.0):
+    try:
+        labels = fcluster(tree, t=k, criterion="maxclust")
+        # Reject trivially bad cuts before scoring. The size floor is opt-in
+        # (min_cluster_size > 1): real messages always have a few outliers, and
+        # cuts that split them off are usually the right ones
+        sizes = np.bincount(labels)
+        sizes = sizes[sizes > 0]
+        if sizes.max() > max_cluster_frac * len(labels) or sizes.min() < min_cluster_size:
+            return labels, None
+        return labels, score_fn(X, labels)
+    except Exception:
+        return None, None
+
+
+# Pre-exported INT8 graph shipped in the all-MiniLM-L6-v2 hub repo (AVX-512 VNNI kernels)
+ONNX_QUANTIZED_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+
+
+def default_device() -> str:
+    # Same preference order SentenceTransformer uses when no device is given
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
 class EmbedCluster:
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
-        print(f"Loading embedding model: {model_name}")
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name="all-MiniLM-L6-v2", batch_size=1024, backend="torch", quantized=False):
+        self.model_kwargs = {}
+        if quantized:
+            # Only the ONNX export ships a pre-quantised graph
+            if backend != "onnx":
+                raise ValueError(f"quantized=True requires backend='onnx', got backend={backend!r}")
+            self.model_kwargs["file_name"] = ONNX_QUANTIZED_FILE
+
+        self.model_name = model_name
+        self.backend = backend
+        self.device = default_device()
+        self.batch_size = batch_size
+        # Everything that changes the vectors; used to key the on-disk embedding cache.
+        # Known before loading, so a cache hit never has to load the model
+        self.cache_key = "|".join([model_name, backend, self.model_kwargs.get("file_name", ""), self.device])
+        self._model = None
+
+    @property
+    def model(self) -> SentenceTransformer:
+        if self._model is None:
+            print(f"Loading embedding model: {self.model_name} (backend={self.backend})")
+            # "onnx" / "openvino" run the exported graph with fused kernels instead of eager PyTorch
+            self._model = SentenceTransformer(
+                self.model_name, device=self.device, backend=self.backend, model_kwargs=self.model_kwargs
+            )
+
+            if self.backend == "torch" and self.device == "cuda":
+                # fp16 runs on tensor cores; MiniLM embeddings are unaffected in practice
+                self._model.half()
+            else:
+                torch.set_num_threads(os.cpu_count() or 1)
+        return self._model
 
     def embed_texts(self, texts: List[str]) -> np.ndarray:
         print("Embedding messages...")
-        return self.model.encode(texts, show_progress_bar=True, convert_to_numpy=True)
-
-    def auto_cluster(self, embeddings: np.ndarray, min_k=5, max_k=40):
+        # encode() already length-sorts internally and restores the input order
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            show_progress_bar=True,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        )
+        return embeddings.astype(np.float32, copy=False)
+
+    def auto_cluster(
+        self,
+        embeddings: np.ndarray,
+        min_k=5,
+        max_k=40,
+        method="average",
+        silhouette_sample_size=5000,
+        coarse_steps=8,
+        refine_radius=3,
+        memmap_threshold=25000,
+        n_jobs=-1,
+        sweep_score="simplified_silhouette",
+        min_cluster_size=1,
+        max_cluster_frac=0.9,
+    ):
         print("Running clustering sweep...")
         best_score = -1
         best_k = None
@@ -48,37 +263,99 @@ class EmbedCluster:
 
         max_k = min(max_k, embeddings.shape[0] // 2)
 
-        for k in range(min_k, max_k + 1):
-            try:
-                clusterer = AgglomerativeClustering(n_clusters=k)
-                labels = clusterer.fit_predict(embeddings)
-                score = silhouette_score(embeddings, labels)
-            except Exception:
-                continue
+        X = l2_normalize(embeddings)
+
+        # The full silhouette of the winning k is scored on a fixed subsample
+        # so reporting stays O(s^2) for large n
+        n = embeddings.shape[0]
+        sampled = bool(silhouette_sample_size) and n > silhouette_sample_size
+        sample = np.random.default_rng(0).choice(n, silhouette_sample_size, replace=False) if sampled else slice(None)
 
-            if score > best_score:
-                best_score = score
-                best_k = k
-                best_labels = labels
+        score_distances = cosine_distance_matrix(X[sample])
 
-        return best_labels, {"best_k": best_k, "silhouette": best_score}
+        # The dendrogram is the same for every k, so build it once and cut it per k
+        if method in VECTOR_LINKAGES:
+            # Built from the vectors, so no pairwise matrix is needed at all
+            tree = fastcluster.linkage_vector(X, method=method)
+        else:
+            # Past memmap_threshold our condensed copy lives in a temp file. fastcluster
+            # still takes one private float64 copy (4n^2 bytes) in RAM; with float64 input
+            # and preserve_input=False it works in that copy instead of making a second
+            with condensed_buffer(n, memmap_threshold) as condensed:
+                condensed_cosine_distances(X, out=condensed)
+                tree = fastcluster.linkage(condensed, method=method, preserve_input=False)
+
+        score_fn = SWEEP_SCORES[sweep_score]
+        score_X = X
+        if sweep_score == "simplified_silhouette" and torch.cuda.is_available():
+            # One host-to-device copy per sweep; every k is then scored on the GPU
+            score_fn = simplified_silhouette_torch
+            score_X = torch.from_numpy(X).to("cuda")
+        limits = (min_cluster_size, max_cluster_frac)
+        scores = {}
+
+        def evaluate(ks):
+            nonlocal best_score, best_k, best_labels
+            # Rejected/failed k stay None, so they are retried if the limits are relaxed
+            ks = [k for k in ks if scores.get(k) is None]
+            # Each k is an independent cut + score; these are short NumPy-bound
+            # tasks, so threads avoid pickling the tree and embeddings per task
+            results = Parallel(n_jobs=n_jobs, backend="threading")(
+                delayed(_cut_and_score)(tree, score_X, k, score_fn, *limits) for k in ks
+            )
+            for k, (labels, score) in zip(ks, results):
+                scores[k] = score
+                if score is not None and score > best_score:
+                    best_score = score
+                    best_k = k
+                    best_labels = labels
+
+        # Silhouette vs k is smooth, so scan a coarse log-spaced grid first and
+        # then refine around its best k instead of scoring every integer
+        if max_k >= min_k:
+            coarse = np.unique(np.round(np.geomspace(min_k, max_k, coarse_steps)).astype(int)).tolist()
+            evaluate(coarse)
+            if best_k is None:
+                # Every coarse cut was degenerate; rank them anyway rather than return nothing
+                limits = (1, 1.0)
+                evaluate(coarse)
+        if best_k is not None:
+            evaluate(range(max(min_k, best_k - refine_radius), min(max_k, best_k + refine_radius) + 1))
+
+        # The sweep ranks k by the cheap score; report the full silhouette for the winner
+        silhouette = -1
+        if best_labels is not None:
+            silhouette = silhouette_score(score_distances, best_labels[sample], metric="precomputed")
+
+        return best_labels, {
+            "best_k": best_k,
+            "silhouette": silhouette,
+            sweep_score: best_score,
+            "evaluated_k": sum(score is not None for score in scores.values()),
+        }
 
 
 # ----------------------------------------------------------------------
 # 4. CLUSTER STATS (FOR FINDING SPLIT-WORTHY INTENTS)
 # ----------------------------------------------------------------------
 
-def compute_cluster_stats(labels, messages):
-    clusters = {}
+def compute_cluster_stats(labels, messages) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Columnar (CSR-style) cluster membership: returns (cluster_ids, sizes, indptr, indices)
+    where indices[indptr[i]:indptr[i + 1]] are the message indexes of cluster_ids[i].
+    """
+    labels = np.asarray(labels)
 
-    for idx, cluster_id in enumerate(labels):
-        clusters.setdefault(cluster_id, {"indexes": []})
-        clusters[cluster_id]["indexes"].append(idx)
+    # Group by sorting once instead of a per-message dict lookup
+    indices = np.argsort(labels, kind="stable")
+    sorted_labels = labels[indices]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(sorted_labels)) + 1))
 
-    for cid, info in clusters.items():
-        info["size"] = len(info["indexes"])
+    cluster_ids = sorted_labels[starts]
+    indptr = np.append(starts, len(labels))
+    sizes = np.diff(indptr)
 
-    return clusters
+    return cluster_ids, sizes, indptr, indices
 
 
 # ----------------------------------------------------------------------
@@ -104,7 +381,42 @@ def call_llm_label_cluster(example_texts: List[str]):
 # 6. MAIN PIPELINE
 # ----------------------------------------------------------------------
 
-def run_pipeline(input_path, output_dir="output"):
+def embedding_cache_path(output_dir: str, texts: List[str], cache_key: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(cache_key.encode("utf-8"))
+    # preprocess_text strips newlines, so joining on them is unambiguous
+    digest.update("\n".join(texts).encode("utf-8"))
+    return os.path.join(output_dir, f"emb_{digest.hexdigest()}.npy")
+
+
+def save_embeddings(path: str, embeddings: np.ndarray) -> None:
+    # Write next to the target and rename into place, so an interrupted run never
+    # leaves a truncated .npy behind for the next run to memory-map
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, embeddings)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_json_array(path: str, items) -> None:
+    """
+    Stream a JSON array one element at a time, so the full list never has to
+    exist in memory. Layout matches json.dump(..., indent=2, ensure_ascii=False).
+    """
+    with open(path, "wb") as f:
+        separator = b"[\n  "
+        for item in items:
+            f.write(separator)
+            f.write(orjson.dumps(item, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n  "))
+            separator = b",\n  "
+        f.write(b"[]" if separator == b"[\n  " else b"\n]")
+
+
+def run_pipeline(input_path, output_dir="output", backend="torch", quantized=False):
     os.makedirs(output_dir, exist_ok=True)
 
     print("Loading dataset...")
@@ -124,8 +436,14 @@ def run_pipeline(input_path, output_dir="output"):
         processed.append(txt_clean)
 
     # ------------ EMBEDDINGS ------------
-    embedder = EmbedCluster()
-    embeddings = embedder.embed_texts(processed)
+    embedder = EmbedCluster(backend=backend, quantized=quantized)
+    cache_path = embedding_cache_path(output_dir, processed, embedder.cache_key)
+    if os.path.exists(cache_path):
+        print("Loading cached embeddings:", cache_path)
+        embeddings = np.load(cache_path, mmap_mode="r")
+    else:
+        embeddings = embedder.embed_texts(processed)
+        save_embeddings(cache_path, embeddings)
 
     # ------------ CLUSTERING ------------
     labels, meta = embedder.auto_cluster(embeddings)
@@ -133,19 +451,22 @@ def run_pipeline(input_path, output_dir="output"):
     print("BEST CLUSTER COUNT =", meta["best_k"])
     print("SILHOUETTE SCORE =", meta["silhouette"])
 
-    clusters = compute_cluster_stats(labels, messages)
+    cluster_ids, sizes, indptr, indices = compute_cluster_stats(labels, messages)
+    members = indices.tolist()
 
     # Save raw clusters for analysis before LLM step
-    raw_output = []
-    for cid, info in clusters.items():
-        raw_output.append({
-            "cluster_id": int(cid),
-            "size": info["size"],
-            "messages": [processed[i] for i in info["indexes"]]
-        })
-
-    with open(f"{output_dir}/cluster_raw.json", "w", encoding="utf-8") as f:
-        json.dump(raw_output, f, indent=2, ensure_ascii=False)
+    raw_output = (
+        {
+            "cluster_id": cid,
+            "size": size,
+            "messages": [processed[i] for i in members[start:stop]]
+        }
+        for cid, size, start, stop in zip(
+            cluster_ids.tolist(), sizes.tolist(), indptr[:-1].tolist(), indptr[1:].tolist()
+        )
+    )
+
+    write_json_array(f"{output_dir}/cluster_raw.json", raw_output)
 
     print("Cluster raw output saved at:", f"{output_dir}/cluster_raw.json")
     print("STEP 3 COMPLETED — Now ready for LLM labeling in STEP 4.")
@@ -5,10 +5,13 @@ Final fixed version — JSON escaping + Gemini 3 API
 
 import os
 import json
-import time
+import asyncio
 import re
 from typing import List, Dict, Any
 import google.generativeai as genai
+import msgspec
+import orjson
+from aiolimiter import AsyncLimiter
 
 # --------------------------------
 # CONFIG
@@ -18,6 +21,10 @@ MODEL_NAME = "gemini-2.5-flash"
 
 
 MIN_CLUSTER_SIZE = 12
+MAX_PROMPT_EXAMPLES = 8
+MAX_EXAMPLE_CHARS = 300
+MAX_CONCURRENT_REQUESTS = 8
+REQUESTS_PER_MINUTE = 60
 OUTPUT_DIR = "output"
 CLUSTER_RAW = os.path.join(OUTPUT_DIR, "cluster_raw.json")
 SUGGESTIONS_PATH = os.path.join(OUTPUT_DIR, "intent_suggestions.json")
@@ -63,31 +70,74 @@ Cluster messages:
 """
 
 
+# --------------------------------
+# INTENT SCHEMA (mirrors the prompt)
+# --------------------------------
+class IntentProposal(msgspec.Struct):
+    # Only the fields the pipeline acts on are validated; the rest is display
+    # text, so a stray list or null there shouldn't discard the whole proposal
+    label: str
+    id: str
+    level: Any = "secondary"
+    short_description: Any = ""
+    when_to_use: Any = ""
+    examples: List[Any] = []
+    confidence: float = 0.0
+    notes: Any = None
+
+
 # --------------------------------
 # JSON EXTRACTION
 # --------------------------------
+_JSON_OBJECT_RE = re.compile(r"(\{.*\})", re.DOTALL)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
 def extract_json_from_text(text: str) -> str:
-    match = re.search(r"(\{.*\})", text, flags=re.DOTALL)
+    match = _JSON_OBJECT_RE.search(text)
     if not match:
         return text
     candidate = match.group(1)
     candidate = candidate.replace("'", '"')
-    candidate = re.sub(r",\s*}", "}", candidate)
-    candidate = re.sub(r",\s*]", "]", candidate)
+    # one pass drops trailing commas before both } and ]
+    candidate = _TRAILING_COMMA_RE.sub(r"\1", candidate)
     return candidate
 
 
+# --------------------------------
+# PROMPT EXAMPLES
+# --------------------------------
+def select_examples(messages: List[str]) -> List[str]:
+    """
+    Drop near-verbatim repeats (case/whitespace only) and cap each message's length,
+    so the prompt spends tokens on distinct phrasings.
+    """
+    seen = set()
+    sample = []
+    for m in messages:
+        key = "".join(m.lower().split())
+        if key in seen:
+            continue
+        seen.add(key)
+        sample.append(m[:MAX_EXAMPLE_CHARS])
+        if len(sample) == MAX_PROMPT_EXAMPLES:
+            break
+    return sample
+
+
 # --------------------------------
 # GEMINI CALL
 # --------------------------------
-def label_cluster_with_gemini(messages: List[str]) -> Dict[str, Any]:
+async def label_cluster_with_gemini(
+    messages: List[str], model: genai.GenerativeModel, semaphore: asyncio.Semaphore, limiter: AsyncLimiter
+) -> Dict[str, Any]:
     examples_text = "\n".join([f"- {m}" for m in messages])
     prompt = PROMPT_TEMPLATE.format(examples=examples_text)
 
-    model = genai.GenerativeModel(MODEL_NAME)
-
     try:
-        response = model.generate_content(prompt)
+        # semaphore bounds in-flight calls, limiter caps the request rate
+        async with semaphore, limiter:
+            response = await model.generate_content_async(prompt)
         raw_text = response.text
     except Exception as e:
         return {
@@ -104,8 +154,9 @@ def label_cluster_with_gemini(messages: List[str]) -> Dict[str, Any]:
     json_text = extract_json_from_text(raw_text)
 
     try:
-        obj = json.loads(json_text)
-    except:
+        # Parse + validate in one step; strict=False also coerces "0.8"-style confidences
+        obj = msgspec.json.decode(json_text, type=IntentProposal, strict=False)
+    except msgspec.DecodeError:
         return {
             "label": "json_parse_failed",
             "id": "json_parse_failed",
@@ -117,57 +168,64 @@ def label_cluster_with_gemini(messages: List[str]) -> Dict[str, Any]:
             "notes": raw_text[:500]
         }
 
-    obj.setdefault("confidence", 0.0)
-    obj["confidence"] = float(obj["confidence"])
-
-    return obj
+    return msgspec.structs.asdict(obj)
 
 
 # --------------------------------
 # MAIN PIPELINE
 # --------------------------------
-def main():
-    configure_genai()
+async def label_cluster(
+    cluster: Dict[str, Any], model: genai.GenerativeModel, semaphore: asyncio.Semaphore, limiter: AsyncLimiter
+) -> Dict[str, Any]:
+    cid = cluster["cluster_id"]
+    size = cluster["size"]
+    messages = cluster["messages"]
+
+    if size < MIN_CLUSTER_SIZE:
+        return {
+            "cluster_id": cid,
+            "size": size,
+            "status": "skipped_small_cluster",
+            "reason": f"size < {MIN_CLUSTER_SIZE}",
+            "examples": messages[:3]
+        }
 
-    if not os.path.exists(CLUSTER_RAW):
-        raise FileNotFoundError("cluster_raw.json not found — run embedding pipeline first.")
+    print(f"\nLabeling cluster {cid} (size={size})...")
 
-    with open(CLUSTER_RAW, "r", encoding="utf-8") as f:
-        clusters = json.load(f)
+    sample = select_examples(messages)
+    llm_output = await label_cluster_with_gemini(sample, model, semaphore, limiter)
 
-    suggestions = []
+    status = "candidate_high_confidence" if llm_output["confidence"] >= 0.6 else "candidate_low_confidence"
 
-    for cluster in clusters:
-        cid = cluster["cluster_id"]
-        size = cluster["size"]
-        messages = cluster["messages"]
+    return {
+        "cluster_id": cid,
+        "size": size,
+        "llm_output": llm_output,
+        "status": status,
+        "examples": sample
+    }
 
-        if size < MIN_CLUSTER_SIZE:
-            suggestions.append({
-                "cluster_id": cid,
-                "size": size,
-                "status": "skipped_small_cluster",
-                "reason": f"size < {MIN_CLUSTER_SIZE}",
-                "examples": messages[:3]
-            })
-            continue
 
-        print(f"\nLabeling cluster {cid} (size={size})...")
+async def label_clusters(clusters: List[Dict[str, Any]], model: genai.GenerativeModel) -> List[Dict[str, Any]]:
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = AsyncLimiter(REQUESTS_PER_MINUTE, time_period=60)
 
-        sample = messages[:12]
-        llm_output = label_cluster_with_gemini(sample)
+    # gather() keeps results in input order, so suggestions line up with cluster_raw.json
+    return await asyncio.gather(*(label_cluster(c, model, semaphore, limiter) for c in clusters))
 
-        status = "candidate_high_confidence" if llm_output["confidence"] >= 0.6 else "candidate_low_confidence"
 
-        suggestions.append({
-            "cluster_id": cid,
-            "size": size,
-            "llm_output": llm_output,
-            "status": status,
-            "examples": sample
-        })
+def main():
+    configure_genai()
+    # One client for every cluster; the async calls all share it
+    model = genai.GenerativeModel(MODEL_NAME)
+
+    if not os.path.exists(CLUSTER_RAW):
+        raise FileNotFoundError("cluster_raw.json not found — run embedding pipeline first.")
+
+    with open(CLUSTER_RAW, "rb") as f:
+        clusters = orjson.loads(f.read())
 
-        time.sleep(0.4)
+    suggestions = asyncio.run(label_clusters(clusters, model))
 
     # Save
     output = {"model": MODEL_NAME, "suggestions": suggestions}